@@ -12,9 +12,9 @@ def make_pairs(imgs, scene_graph='complete', prefilter=None, symmetrize=True):
     pairs = []
 
     if scene_graph == 'complete':  # complete graph
-        for i in range(len(imgs)):
-            for j in range(i):
-                pairs.append((imgs[i], imgs[j]))
+        # all (i, j) with j < i, in the same order as looping over i then j
+        idx1, idx2 = np.tril_indices(len(imgs), k=-1)
+        pairs = [(imgs[i], imgs[j]) for i, j in zip(idx1, idx2)]
 
     elif scene_graph.startswith('swin'):
         winsize = int(scene_graph.split('-')[1]) if '-' in scene_graph else 3
@@ -6,11 +6,15 @@
 # --------------------------------------------------------
 import tqdm
 import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dust3r.utils.device import to_cpu, collate_with_cat
 from dust3r.model import AsymmetricCroCo3DStereo, inf  # noqa: F401, needed when loading the model
-from dust3r.utils.misc import invalid_to_nans
+from dust3r.utils.misc import invalid_to_nans, is_symmetrized
 from dust3r.utils.geometry import depthmap_to_pts3d, geotrf
 
+PREFETCH_DEPTH = 2  # batches uploaded ahead of the one going through the model
+
 
 def load_model(model_path, device):
     print('... loading model from', model_path)
@@ -27,6 +31,106 @@ def load_model(model_path, device):
     return net.to(device)
 
 
+def compile_model(model, mode=None):
+    """ torch.compile the tensor-only parts of the model (encoder, decoder, heads).
+    forward() itself stays eager: it branches on the python 'instance' lists of the views,
+    on which dynamo would guard and recompile for every batch.
+    No cudagraphs ('reduce-overhead'): each compiled part and input shape would get its own
+    cudagraph tree entry, whose replay overwrites the outputs still held by the others.
+    """
+    torch._dynamo.reset()
+    model._encode_image = torch.compile(model._encode_image, mode=mode)
+    model._decoder = torch.compile(model._decoder, mode=mode)
+    for head in (model.downstream_head1, model.downstream_head2):
+        head.forward = torch.compile(head.forward, mode=mode)
+    return model
+
+
+def _get_autocast_cuda_state():
+    if hasattr(torch, 'get_autocast_dtype'):  # torch >= 2.4, get_autocast_gpu_dtype is deprecated
+        return torch.is_autocast_enabled('cuda'), torch.get_autocast_dtype('cuda')
+    return torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+
+
+class CUDAGraphModel (torch.nn.Module):
+    """ Replay the forward pass of the model with a CUDA graph captured on the first cuda batch.
+    Batches with another signature (shapes, true_shape, symmetry, autocast) run eagerly.
+    If the capture fails, every batch runs eagerly and the error is kept in capture_error.
+    Only pays off for many small batches of the same signature: the capture costs num_warmup + 1
+    forwards and a private memory pool, so large batches (few replays) are faster eagerly.
+    """
+
+    def __init__(self, model, num_warmup=3):
+        super().__init__()
+        self.model = model
+        self.num_warmup = num_warmup
+        self.graph = None
+        self.signature = None
+        self.capture_error = None
+
+    @staticmethod
+    def _signature(view1, view2):
+        def view_signature(view):
+            true_shape = view.get('true_shape')
+            if true_shape is not None:
+                true_shape = tuple(map(tuple, torch.as_tensor(true_shape).tolist()))
+            return tuple(view['img'].shape), view['img'].dtype, view['img'].device, true_shape
+        autocast = _get_autocast_cuda_state()
+        return view_signature(view1), view_signature(view2), is_symmetrized(view1, view2), autocast
+
+    def _capture(self, view1, view2):
+        # static inputs, the model only reads img, true_shape and instance
+        self.static_view1, self.static_view2 = [
+            dict(img=view['img'].clone(), true_shape=view.get('true_shape'), instance=view['instance'])
+            for view in (view1, view2)]
+
+        enabled, dtype = _get_autocast_cuda_state()
+        with torch.autocast('cuda', enabled=enabled, dtype=dtype, cache_enabled=False):
+            # warmup on a side stream, as required before capture
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(self.num_warmup):
+                    self.model(self.static_view1, self.static_view2)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            try:
+                # prefetch_batches keeps uploading from its worker thread during the capture,
+                # in "global" mode its (legal) cuda calls would invalidate the capture
+                with torch.cuda.graph(graph, capture_error_mode='thread_local'):
+                    self.static_out = self.model(self.static_view1, self.static_view2)
+            except RuntimeError as e:
+                # the signature stays set, so that the capture is not retried on every batch
+                print(f'/!\\ could not capture the forward pass in a cuda graph, running eagerly ({e}) /!\\')
+                self.capture_error = e
+                del self.static_view1, self.static_view2
+                return
+        self.graph = graph
+
+    def extra_repr(self):
+        if self.capture_error is not None:
+            return f'eager, capture failed: {self.capture_error}'
+        return 'captured' if self.graph is not None else 'not captured yet'
+
+    def forward(self, view1, view2):
+        if view1['img'].device.type != 'cuda':
+            return self.model(view1, view2)
+
+        signature = self._signature(view1, view2)
+        if self.signature is None:
+            self.signature = signature
+            self._capture(view1, view2)
+        if self.graph is None or signature != self.signature:
+            return self.model(view1, view2)
+
+        self.static_view1['img'].copy_(view1['img'])
+        self.static_view2['img'].copy_(view2['img'])
+        self.graph.replay()
+        # outputs are overwritten at each replay
+        return tuple({k: v.clone() for k, v in res.items()} for res in self.static_out)
+
+
 def _interleave_imgs(img1, img2):
     res = {}
     for key, value1 in img1.items():
@@ -45,7 +149,8 @@ def make_batch_symmetric(batch):
     return view1, view2
 
 
-def loss_of_one_batch(batch, model, criterion, device, symmetrize_batch=False, use_amp=False, ret=None):
+def loss_of_one_batch(batch, model, criterion, device, symmetrize_batch=False, use_amp=False, ret=None,
+                      amp_dtype=torch.float16):
     view1, view2 = batch
     for view in batch:
         for name in 'img pts3d valid_mask camera_pose camera_intrinsics F_matrix corres'.split():  # pseudo_focal
@@ -56,7 +161,7 @@ def loss_of_one_batch(batch, model, criterion, device, symmetrize_batch=False, u
     if symmetrize_batch:
         view1, view2 = make_batch_symmetric(batch)
 
-    with torch.cuda.amp.autocast(enabled=bool(use_amp)):
+    with torch.cuda.amp.autocast(enabled=bool(use_amp), dtype=amp_dtype):
         pred1, pred2 = model(view1, view2)
 
         # loss is supposed to be symmetric
@@ -68,7 +173,10 @@ def loss_of_one_batch(batch, model, criterion, device, symmetrize_batch=False, u
 
 
 @torch.no_grad()
-def inference(pairs, model, device, batch_size=8):
+def inference(pairs, model, device, batch_size=8, amp_dtype=None):
+    """ amp_dtype: run the encoder/decoder under autocast with this dtype (None for fp32).
+    the heads always run in fp32, so the returned pointmaps and confidences are fp32.
+    """
     print(f'>> Inference with model on {len(pairs)} image pairs')
     result = []
 
@@ -77,9 +185,12 @@ def inference(pairs, model, device, batch_size=8):
     if multiple_shapes:  # force bs=1
         batch_size = 1
 
-    for i in tqdm.trange(0, len(pairs), batch_size):
-        res = loss_of_one_batch(collate_with_cat(pairs[i:i+batch_size]), model, None, device)
-        result.append(to_cpu(res))
+    chunks = [pairs[i:i+batch_size] for i in range(0, len(pairs), batch_size)]
+    for batch in tqdm.tqdm(prefetch_batches(chunks, device), total=len(chunks)):
+        with torch.inference_mode():
+            res = loss_of_one_batch(batch, model, None, device, use_amp=amp_dtype is not None, amp_dtype=amp_dtype)
+        # the global aligner wraps the predictions in nn.Parameter, which inference tensors do not allow
+        result.append(_clone_inference_tensors(to_cpu(res)))
 
     result = collate_with_cat(result, lists=multiple_shapes)
 
@@ -87,6 +198,49 @@ def inference(pairs, model, device, batch_size=8):
     return result
 
 
+def prefetch_batches(chunks, device, depth=PREFETCH_DEPTH):
+    """ collate chunks of pairs and upload them to the gpu on a side stream,
+    so that the next batches are transferred while the current one goes through the model
+    """
+    if torch.device(device).type != 'cuda':
+        yield from map(collate_with_cat, chunks)
+        return
+
+    copy_stream = torch.cuda.Stream(device)
+
+    def upload(chunk):
+        batch = collate_with_cat(chunk)
+        with torch.cuda.stream(copy_stream):
+            for view in batch:
+                view['img'] = view['img'].pin_memory().to(device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(copy_stream)
+        return batch, event
+
+    # ring buffer of `depth` batches in flight
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = deque(pool.submit(upload, chunk) for chunk in chunks[:depth])
+        for i in range(len(chunks)):
+            batch, event = pending.popleft().result()
+            if i + depth < len(chunks):
+                pending.append(pool.submit(upload, chunks[i + depth]))
+            stream = torch.cuda.current_stream(device)
+            stream.wait_event(event)
+            for view in batch:
+                view['img'].record_stream(stream)
+            yield batch
+
+
+def _clone_inference_tensors(x):
+    if isinstance(x, dict):
+        return {k: _clone_inference_tensors(v) for k, v in x.items()}
+    if isinstance(x, (tuple, list)):
+        return type(x)(_clone_inference_tensors(v) for v in x)
+    if isinstance(x, torch.Tensor) and x.is_inference():
+        return x.clone()  # outside of inference_mode, this gives a regular tensor
+    return x
+
+
 def check_if_same_size(pairs):
     shapes1 = [img1['img'].shape[-2:] for img1, img2 in pairs]
     shapes2 = [img2['img'].shape[-2:] for img1, img2 in pairs]
@@ -143,7 +143,7 @@ class AsymmetricCroCo3DStereo (CroCoNet):
         # normalize last output
         del final_output[1]  # duplicate with final_output[0]
         final_output[-1] = tuple(map(self.dec_norm, final_output[-1]))
-        return zip(*final_output)
+        return tuple(zip(*final_output))
 
     def _downstream_head(self, head_num, decout, img_shape):
         B, S, D = decout[-1].shape
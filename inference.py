@@ -12,24 +12,120 @@ import torch
 import numpy as np
 import tempfile
 import functools
+import weakref
 import trimesh
-import copy
 from scipy.spatial.transform import Rotation
 
-from dust3r.inference import inference, load_model
+from dust3r.inference import inference, load_model, compile_model, PREFETCH_DEPTH
 from dust3r.image_pairs import make_pairs
 from dust3r.utils.image import load_images, rgb
 from dust3r.utils.device import to_numpy
+from dust3r.utils.geometry import geotrf
 from dust3r.viz import add_scene_cam, CAM_COLORS, OPENGL, pts3d_to_trimesh, cat_meshes
 from dust3r.cloud_opt import global_aligner, GlobalAlignerMode
 import open3d as o3d
 import matplotlib.pyplot as pl
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 pl.ion()
 
 torch.backends.cuda.matmul.allow_tf32 = True  # for gpu >= Ampere and pytorch >= 1.12
-batch_size = 1
+# tuned once per new input shape, warmup_model runs the common ones ahead of time
+torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.deterministic = False
+max_batch_size = 64
+pair_memory_per_pixel = {}  # peak gpu memory of one pair per pixel, per autocast dtype
+batch_memory_fraction = 0.8  # headroom for fragmentation and allocations outside the forward
+precisions = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+jet_lut = pl.get_cmap("jet")(np.arange(256))  # same 256 rgba entries that cmap() samples
+
+
+def get_amp_dtype(precision):
+    """
+    autocast dtype of a --precision value, bf16 falls back to fp16 on gpus without bf16 support
+    """
+    amp_dtype = precisions[precision]
+    if (
+        amp_dtype is torch.bfloat16
+        and torch.cuda.is_available()
+        and not torch.cuda.is_bf16_supported()
+    ):
+        return torch.float16
+    return amp_dtype
+
+
+def _dummy_views(H, W, n=2):
+    return [
+        dict(
+            img=torch.zeros((1, 3, H, W)),
+            true_shape=np.int32([[H, W]]),
+            idx=i,
+            instance=str(i),
+        )
+        for i in range(n)
+    ]
+
+
+def measure_pair_memory(model, device, image_size, amp_dtype=None):
+    """
+    measure the peak gpu memory of one pair through the (eager) model, for get_batch_size
+    """
+    if not torch.cuda.is_available() or torch.device(device).type != "cuda":
+        return
+    H, W = (224, 224) if image_size == 224 else (384, 512)
+    pairs = make_pairs(_dummy_views(H, W), scene_graph="complete", prefilter=None)
+    torch.cuda.reset_peak_memory_stats(device)
+    allocated = torch.cuda.memory_allocated(device)
+    inference(pairs[:1], model, device, batch_size=1, amp_dtype=amp_dtype)
+    peak = torch.cuda.max_memory_allocated(device) - allocated
+    pair_memory_per_pixel[amp_dtype] = max(peak, 1) / (H * W)
+
+
+def get_batch_size(pairs, device, amp_dtype=None):
+    """
+    pack as many pairs as fit in the free gpu memory into one forward pass,
+    stays at 1 until measure_pair_memory has been run for this amp_dtype
+    """
+    if not torch.cuda.is_available() or torch.device(device).type != "cuda":
+        return 1
+    if amp_dtype not in pair_memory_per_pixel:
+        return 1
+    free, _ = torch.cuda.mem_get_info(device)
+    # memory reserved by the caching allocator but not used by any tensor is free for us too
+    free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    num_pixels = max(v["img"].shape[-2] * v["img"].shape[-1] for p in pairs for v in p)
+    pair_memory = pair_memory_per_pixel[amp_dtype] * num_pixels
+    # the float32 images of the batches prefetch_batches uploads ahead of this one
+    pair_memory += PREFETCH_DEPTH * 2 * 3 * num_pixels * 4
+    num_pairs = int(batch_memory_fraction * free // pair_memory)
+    return max(1, min(len(pairs), max_batch_size, num_pairs))
+
+
+def warmup_model(model, device, image_size, precision="bf16"):
+    """
+    run a full batch (as sized by get_batch_size) of the common input shapes through the model,
+    4:3 and 16:9 in both orientations, so that most requests do not pay for the cudnn/cublas
+    autotuning. other crops load_images may produce, and smaller batches, are tuned on first use
+    """
+    amp_dtype = get_amp_dtype(precision)
+    if image_size == 224:
+        shapes = [(224, 224)]
+    else:
+        shapes = [(384, 512), (512, 384), (288, 512), (512, 288)]
+    # enough views for max_batch_size pairs in the complete graph
+    num_views = int(np.ceil(np.sqrt(max_batch_size))) + 1
+    for H, W in shapes:
+        pairs = make_pairs(
+            _dummy_views(H, W, n=num_views),
+            scene_graph="complete",
+            prefilter=None,
+            symmetrize=True,
+        )
+        batch_size = get_batch_size(pairs, device, amp_dtype)
+        inference(
+            pairs[:batch_size], model, device, batch_size=batch_size, amp_dtype=amp_dtype
+        )
 
 
 def get_args_parser():
@@ -46,6 +142,20 @@ def get_args_parser():
         default=2,
         help="number of images to reconstruct the scene",
     )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="bf16",
+        choices=list(precisions),
+        help="autocast dtype of the model forward (the default used to be fp32, "
+        "bf16 falls back to fp16 on gpus without bf16), global alignment always runs in fp32",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="compile the model with torch.compile at load time",
+    )
     return parser
 
 
@@ -63,25 +173,37 @@ def _convert_scene_output_to_glb(
     transparent_cams=False,
 ):
     assert len(pts3d) == len(mask) <= len(imgs) <= len(cams2world) == len(focals)
-    pts3d = to_numpy(pts3d)
     imgs = to_numpy(imgs)
     focals = to_numpy(focals)
     cams2world = to_numpy(cams2world)
 
     scene = trimesh.Scene()
 
+    # transform to the export frame, applied to the vertices before building the
+    # geometries instead of through scene.apply_transform
+    rot = np.eye(4)
+    rot[:3, :3] = Rotation.from_euler("y", np.deg2rad(180)).as_matrix()
+    transform = np.linalg.inv(cams2world[0] @ OPENGL @ rot)
+
     # full pointcloud
     if as_pointcloud:
-        pts = np.concatenate([p[m] for p, m in zip(pts3d, mask)])
-        col = np.concatenate([p[m] for p, m in zip(imgs, mask)])
-        pct = trimesh.PointCloud(pts.reshape(-1, 3), colors=col.reshape(-1, 3))
+        # flatten all views first, then gather the valid points in a single pass
+        # on the device of the pointmaps, so that only the kept points are transferred
+        msk = torch.cat([torch.as_tensor(m).ravel() for m in mask])
+        pts = torch.cat([torch.as_tensor(p).reshape(-1, 3) for p in pts3d])[msk]
+        pts = geotrf(torch.as_tensor(transform, dtype=pts.dtype, device=pts.device), pts)
+        pts, msk = to_numpy((pts, msk))
+        col = np.concatenate([p.reshape(-1, 3) for p in imgs[: len(mask)]])[msk]
+        pct = trimesh.PointCloud(pts, colors=col)
         scene.add_geometry(pct)
     else:
-        meshes = []
-        for i in range(len(imgs)):
-            meshes.append(pts3d_to_trimesh(imgs[i], pts3d[i], mask[i]))
-        mesh = trimesh.Trimesh(**cat_meshes(meshes))
-        scene.add_geometry(mesh)
+        pts3d, mask = to_numpy(pts3d), to_numpy(mask)
+        # numpy releases the gil on the heavy indexing, threads are enough
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            meshes = list(pool.map(pts3d_to_trimesh, imgs, pts3d, mask))
+        mesh = cat_meshes(meshes)
+        mesh["vertices"] = geotrf(transform, mesh["vertices"])
+        scene.add_geometry(trimesh.Trimesh(**mesh))
 
     # add each camera
     # for i, pose_c2w in enumerate(cams2world):
@@ -91,7 +213,7 @@ def _convert_scene_output_to_glb(
     #         camera_edge_color = cam_color or CAM_COLORS[i % len(CAM_COLORS)]
     #     add_scene_cam(
     #         scene,
-    #         pose_c2w,
+    #         transform @ pose_c2w,
     #         camera_edge_color,
     #         None if transparent_cams else imgs[i],
     #         focals[i],
@@ -99,20 +221,63 @@ def _convert_scene_output_to_glb(
     #         screen_width=cam_size,
     #     )
 
-    rot = np.eye(4)
     type = ""
     if as_pointcloud:
         type = "pointcloud"
     else:
         type = "mesh"
-    rot[:3, :3] = Rotation.from_euler("y", np.deg2rad(180)).as_matrix()
-    scene.apply_transform(np.linalg.inv(cams2world[0] @ OPENGL @ rot))
     outfile = os.path.join(outdir, f"{scene_name}_{type}.glb")
     print("(exporting 3D scene to", outfile, ")")
     scene.export(file_obj=outfile)
     return outfile
 
 
+max_cached_geometries = 4  # per scene
+# outside of the scene's __dict__, so that deepcopy(scene) in clean_pointcloud/mask_sky
+# does not copy the cached tensors; entries are freed with their scene
+scene_geometry_cache = weakref.WeakKeyDictionary()
+
+
+def _get_scene_geometry(scene, min_conf_thr, mask_sky, clean_depth):
+    """
+    optimized values of a scene, only recomputed when an option they depend on changes
+    (cam_size, as_pointcloud... reuse them). cached per scene object, so it is freed
+    with it and not shared between gradio sessions.
+    scene.min_conf_thr must already be set for min_conf_thr, see get_3D_model_from_scene
+    """
+    cache = scene_geometry_cache.setdefault(scene, {})
+    # slider values like 3.0000000001 should still hit the cache
+    key = (round(float(min_conf_thr), 2), mask_sky, clean_depth)
+    if key not in cache:
+        if len(cache) >= max_cached_geometries:
+            del cache[next(iter(cache))]  # oldest entry
+        cache[key] = _compute_scene_geometry(scene, mask_sky, clean_depth)
+    return cache[key]
+
+
+def _compute_scene_geometry(scene, mask_sky, clean_depth):
+    # post processes
+    if clean_depth:
+        scene = scene.clean_pointcloud()
+    if mask_sky:
+        scene = scene.mask_sky()
+
+    # get optimized values from scene
+    rgbimg = scene.imgs
+    # bring focals and poses to the host together, one copy and one sync instead of two
+    focals, cams2world = scene.get_focals().detach(), scene.get_im_poses().detach()
+    n = len(cams2world)
+    cams = torch.cat(
+        (focals.reshape(n, -1).to(cams2world.dtype), cams2world.reshape(n, -1)), dim=1
+    ).cpu()
+    focals = cams[:, :-16].reshape(focals.shape)
+    cams2world = cams[:, -16:].reshape(cams2world.shape)
+    # 3D pointcloud from depthmap, poses and intrinsics, kept on the scene device
+    pts3d = [p.detach() for p in scene.get_pts3d()]
+    msk = scene.get_masks()
+    return rgbimg, pts3d, msk, focals, cams2world
+
+
 def get_3D_model_from_scene(
     outdir,
     scene_name,
@@ -129,20 +294,11 @@ def get_3D_model_from_scene(
     """
     if scene is None:
         return None
-    # post processes
-    if clean_depth:
-        scene = scene.clean_pointcloud()
-    if mask_sky:
-        scene = scene.mask_sky()
-
-    # get optimized values from scene
-    rgbimg = scene.imgs
-    focals = scene.get_focals().cpu()
-    cams2world = scene.get_im_poses().cpu()
-    # 3D pointcloud from depthmap, poses and intrinsics
-    pts3d = to_numpy(scene.get_pts3d())
-    scene.min_conf_thr = float(scene.conf_trf(torch.tensor(min_conf_thr)))
-    msk = to_numpy(scene.get_masks())
+    # set on every call, so that later scene.get_masks() use this threshold even on a cache hit
+    scene.min_conf_thr = scene.conf_trf(torch.as_tensor(min_conf_thr)).item()
+    rgbimg, pts3d, msk, focals, cams2world = _get_scene_geometry(
+        scene, min_conf_thr, mask_sky, clean_depth
+    )
     return _convert_scene_output_to_glb(
         outdir,
         scene_name,
@@ -174,6 +330,7 @@ def get_reconstructed_scene(
     scenegraph_type,
     winsize,
     refid,
+    precision="bf16",
 ):
     """
     from a list of images, run dust3r inference, global aligner.
@@ -181,8 +338,8 @@ def get_reconstructed_scene(
     """
     imgs = load_images(filelist, size=image_size)
     if len(imgs) == 1:
-        imgs = [imgs[0], copy.deepcopy(imgs[0])]
-        imgs[1]["idx"] = 1
+        # second view shares the pixel buffers, pairs only tell views apart by idx/instance
+        imgs = [imgs[0], dict(imgs[0], idx=1, instance=str(1))]
     if scenegraph_type == "swin":
         scenegraph_type = scenegraph_type + "-" + str(winsize)
     elif scenegraph_type == "oneref":
@@ -191,7 +348,14 @@ def get_reconstructed_scene(
     pairs = make_pairs(
         imgs, scene_graph=scenegraph_type, prefilter=None, symmetrize=True
     )
-    output = inference(pairs, model, device, batch_size=batch_size)
+    amp_dtype = get_amp_dtype(precision)
+    output = inference(
+        pairs,
+        model,
+        device,
+        batch_size=get_batch_size(pairs, device, amp_dtype),
+        amp_dtype=amp_dtype,
+    )
 
     mode = (
         GlobalAlignerMode.PointCloudOptimizer
@@ -208,6 +372,7 @@ def get_reconstructed_scene(
 
     outfile = get_3D_model_from_scene(
         outdir,
+        "scene",
         scene,
         min_conf_thr,
         as_pointcloud,
@@ -223,11 +388,11 @@ def get_reconstructed_scene(
     rgbimg = scene.imgs
     depths = to_numpy(scene.get_depthmaps())
     confs = to_numpy([c for c in scene.im_conf])
-    cmap = pl.get_cmap("jet")
-    depths_max = max([d.max() for d in depths])
+    # views may have different shapes, so normalize per view instead of stacking
+    depths_max = max(d.max() for d in depths)
+    confs_max = max(c.max() for c in confs)
     depths = [d / depths_max for d in depths]
-    confs_max = max([d.max() for d in confs])
-    confs = [cmap(d / confs_max) for d in confs]
+    confs = [jet_lut[np.minimum((c * (256 / confs_max)).astype(int), 255)] for c in confs]
 
     imgs = []
     for i in range(len(rgbimg)):
@@ -295,11 +460,22 @@ def set_scenegraph_options(inputfiles, winsize, refid, scenegraph_type):
     return winsize, refid
 
 
-def main_demo(tmpdirname, model, device, image_size, server_name, server_port):
+def main_demo(
+    tmpdirname, model, device, image_size, server_name, server_port, precision="bf16"
+):
+    measure_pair_memory(model, device, image_size, get_amp_dtype(precision))
+    warmup_model(model, device, image_size, precision)
     recon_fun = functools.partial(
-        get_reconstructed_scene, tmpdirname, model, device, image_size
+        get_reconstructed_scene,
+        tmpdirname,
+        model,
+        device,
+        image_size,
+        precision=precision,
+    )
+    model_from_scene_fun = functools.partial(
+        get_3D_model_from_scene, tmpdirname, "scene"
     )
-    model_from_scene_fun = functools.partial(get_3D_model_from_scene, tmpdirname)
     with gradio.Blocks(
         css=""".gradio-container {margin: 0 !important; min-width: 100%};""",
         title="DUSt3R Demo",
@@ -484,27 +660,25 @@ def main_demo(tmpdirname, model, device, image_size, server_name, server_port):
 
 
 def save_camera_poses(poses: torch.tensor, file_names: list, path: str) -> None:
-    # convert pose to nparray
-    M_ext = dict()
+    # convert pose to nparray, with a single device to host copy
     assert len(file_names) == len(poses)
-    for pose, view_name in zip(poses, file_names):
-        image_file = f"{view_name}"
-        M_ext[view_name] = pose.tolist()
+    poses = to_numpy(poses)
+    M_ext = {view_name: pose.tolist() for pose, view_name in zip(poses, file_names)}
     file_path = os.path.join("./estimation", path)
-    if not os.path.isfile(file_path):
-        os.mknod(file_path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
     with open(file_path, "w") as f:
         format_M_ext = {"extrinsics": M_ext}
-        json.dump(format_M_ext, f)
+        json.dump(format_M_ext, f, separators=(",", ":"))
 
 
 def save_point_to_ply(points: np.ndarray, file_name: str) -> None:
     _, dim = points.shape
     if dim == 4:
         points = points[:, :3]
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(points)
-    o3d.io.write_point_cloud(os.path.join("./estimation/", file_name), pcd)
+    # the tensor api wraps the contiguous buffer instead of converting point by point
+    points = np.ascontiguousarray(points, dtype=np.float32)
+    pcd = o3d.t.geometry.PointCloud(o3d.core.Tensor.from_numpy(points))
+    o3d.t.io.write_point_cloud(os.path.join("./estimation/", file_name), pcd)
 
 
 if __name__ == "__main__":
@@ -513,31 +687,38 @@ if __name__ == "__main__":
 
     model_path = "checkpoints/DUSt3R_ViTLarge_BaseDecoder_512_dpt.pth"
     device = "cuda"
-    batch_size = 1
     schedule = "cosine"
     lr = 0.01
     niter = 300
 
     model = load_model(model_path, device)
+    model.eval()
+    # before compiling, so that the measurement runs eagerly
+    amp_dtype = get_amp_dtype(args.precision)
+    measure_pair_memory(model, device, 512, amp_dtype)
+    if args.compile:
+        model = compile_model(model)
     # load_images can take a list of images or a directory
     # load images fom sfm_data/resize_image
-    files_path = []
-    frame_name = []
-
     num_view = args.views
     item = args.item
     resize_image_path = f"sfm_data/{item}_images"
 
-    for filename in os.listdir(f"sfm_data/{item}_images"):
-        if len(files_path) == num_view:
-            break
-        files_path.append(os.path.join(resize_image_path, filename))
-        frame_name.append(filename)
+    # sorted so that the selected views do not depend on the filesystem order
+    with os.scandir(resize_image_path) as it:
+        frame_name = sorted(entry.name for entry in it if entry.is_file())[:num_view]
+    files_path = [os.path.join(resize_image_path, name) for name in frame_name]
 
-    # use the first two images to reconstruct the scene
-    images = load_images(files_path[:num_view], size=512)
+    # use the first num_view images to reconstruct the scene
+    images = load_images(files_path, size=512)
     pairs = make_pairs(images, scene_graph="complete", prefilter=None, symmetrize=True)
-    output = inference(pairs, model, device, batch_size=batch_size)
+    output = inference(
+        pairs,
+        model,
+        device,
+        batch_size=get_batch_size(pairs, device, amp_dtype),
+        amp_dtype=amp_dtype,
+    )
 
     scene = global_aligner(
         output, device=device, mode=GlobalAlignerMode.PointCloudOptimizer
@@ -557,7 +738,7 @@ if __name__ == "__main__":
     get_3D_model_from_scene(f"./estimation/", item, scene)
     get_3D_model_from_scene(f"./estimation/", item, scene, as_pointcloud=True)
     save_camera_poses(poses, frame_name, f"{item}_poses.json")
-    point_cloud = torch.cat(pts3d, dim=0).reshape(-1, 3).detach().cpu().numpy()
+    point_cloud = torch.cat(pts3d, dim=0).detach().reshape(-1, 3).cpu().numpy()
     save_point_to_ply(
         point_cloud,
         f"{item}_point_cloud.ply",
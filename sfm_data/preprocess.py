@@ -6,6 +6,74 @@ import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 from PIL import Image
 import glob
+import torch
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    from nvidia.dali import fn, types
+    from nvidia.dali.pipeline import Pipeline
+    dali_support_enabled = True
+except ImportError:
+    dali_support_enabled = False
+
+RESIZE_W, RESIZE_H = 512, 288
+
+
+def _resize_images_dali(files, batch_size=16, num_threads=4, device_id=0):
+    """decode (nvjpeg) and resize a list of images on the gpu, yield BGR uint8 arrays in input order"""
+    # synchronous, no prefetching: a batch is only read when it is requested
+    pipe = Pipeline(
+        batch_size=batch_size,
+        num_threads=num_threads,
+        device_id=device_id,
+        exec_pipelined=False,
+        exec_async=False,
+        prefetch_queue_depth=1,
+    )
+    with pipe:
+        jpegs = fn.external_source(name="jpegs", dtype=types.UINT8)
+        imgs = fn.decoders.image(jpegs, device="mixed", output_type=types.BGR)
+        imgs = fn.resize(
+            imgs, resize_x=RESIZE_W, resize_y=RESIZE_H, interp_type=types.INTERP_LINEAR
+        )
+        pipe.set_outputs(fn.cast(imgs, dtype=types.UINT8))
+    pipe.build()
+
+    # the encoded files are read here rather than by fn.readers.file, which reads ahead
+    # (and wraps around on the last batch) while earlier outputs are written back in place
+    for i in range(0, len(files), batch_size):
+        chunk = files[i : i + batch_size]
+        pipe.feed_input("jpegs", [np.fromfile(path, dtype=np.uint8) for path in chunk])
+        (out,) = pipe.run()
+        out = out.as_cpu()
+        for j in range(len(chunk)):
+            yield np.array(out.at(j))
+
+
+# libjpeg can downscale by 2, 4 or 8 while decoding, which skips most of the idct work
+REDUCED_READ_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+
+def _imread_reduced(path):
+    """read an image at the smallest decoded resolution that is still larger than the target size"""
+    with Image.open(path) as img:  # only parses the header
+        # exif rotation may swap the sides, so both of them must cover the target
+        min_side = min(img.size)
+    for factor, flag in REDUCED_READ_FLAGS:
+        if min_side // factor >= max(RESIZE_W, RESIZE_H):
+            return cv2.imread(path, flag)
+    return cv2.imread(path)
+
+
+def _resize_one(path_in, path_out):
+    img = _imread_reduced(path_in)
+    img = cv2.resize(img, (RESIZE_W, RESIZE_H), interpolation=cv2.INTER_AREA)
+    cv2.imwrite(path_out, img)
+    print("resize image:", os.path.basename(path_out))
 
 
 def resize_image():
@@ -13,11 +81,27 @@ def resize_image():
     resize_image_path = "sfm_data/box_images"
     if not os.path.exists(resize_image_path):
         os.makedirs(resize_image_path)
-    for filename in os.listdir(image_path):
-        img = cv2.imread(os.path.join(image_path, filename))
-        img = cv2.resize(img, (512, 288))
-        cv2.imwrite(os.path.join(resize_image_path, filename), img)
-        print("resize image:", filename)
+    filenames = sorted(os.listdir(image_path))
+    in_paths = [os.path.join(image_path, filename) for filename in filenames]
+    out_paths = [os.path.join(resize_image_path, filename) for filename in filenames]
+
+    # dali needs a gpu, and an empty batch would fail in pipe.run()
+    if dali_support_enabled and torch.cuda.is_available() and in_paths:
+
+        def save(path_out, img):
+            cv2.imwrite(path_out, img)
+            print("resize image:", os.path.basename(path_out))
+
+        # encoding runs in the pool while the next images are decoded
+        with ThreadPoolExecutor() as pool:
+            list(pool.map(save, out_paths, _resize_images_dali(in_paths)))
+    else:
+        # one image per process, opencv's own threads would only oversubscribe the cores
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(), initializer=cv2.setNumThreads, initargs=(1,)
+        ) as pool:
+            list(pool.map(_resize_one, in_paths, out_paths, chunksize=4))
 
 
-# resize_image()
+if __name__ == "__main__":
+    resize_image()